@@ -0,0 +1,242 @@
+import asyncio
+import contextlib
+import copy
+import functools
+import hashlib
+import importlib.util
+import inspect
+import logging
+import os
+import sqlite3
+import httpx
+import orjson
+from json_repair import repair_json
+from langchain_core.globals import set_verbose
+from langchain_core.runnables import RunnableLambda
+from langchain_openai import ChatOpenAI
+from langchain_mistralai.chat_models import ChatMistralAI
+from mistralai import Mistral
+from pydantic import BaseModel, ValidationError
+
+MISTRAL_API_KEY = ""
+MISTRAL_ENDPOINT = "https://api.mistral.ai/v1"
+OPENAI_API_KEY = ""
+
+logger = logging.getLogger(__name__)
+
+# LangChain의 verbose 출력은 LANGCHAIN_VERBOSE=1 로 요청한 경우에만 켭니다.
+set_verbose(os.environ.get("LANGCHAIN_VERBOSE") == "1")
+
+# 호출이 TLS 세션과 HTTP/2 연결을 재사용하도록 연결 풀 설정을 공유합니다.
+_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=20, keepalive_expiry=60)
+# HTTP/2는 선택 의존성 h2 (httpx[http2])가 설치된 경우에만 사용하고, 없으면 HTTP/1.1 keep-alive로 동작합니다.
+_HTTP2 = importlib.util.find_spec("h2") is not None
+
+##############################################
+# 공유 HTTP 클라이언트
+##############################################
+# 비동기 클라이언트의 연결 풀은 처음 사용한 이벤트 루프에 묶이므로, 이 모듈은 프로세스당 하나의 이벤트 루프를 전제로 합니다.
+# (asyncio.run을 여러 번 호출하지 말고, 오래 실행되는 파이프라인은 하나의 루프 안에서 main_async 등을 await 하세요.)
+@functools.lru_cache(maxsize=None)
+def get_mistral_http() -> httpx.AsyncClient:
+    # ChatMistralAI는 상대 경로로 요청하므로 base_url과 인증 헤더를 클라이언트에 설정합니다.
+    return httpx.AsyncClient(
+        base_url=MISTRAL_ENDPOINT,
+        headers={
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "Authorization": f"Bearer {MISTRAL_API_KEY}",
+        },
+        http2=_HTTP2,
+        limits=_HTTP_LIMITS,
+        timeout=120,
+    )
+
+@functools.lru_cache(maxsize=None)
+def get_openai_http() -> httpx.Client:
+    return httpx.Client(http2=_HTTP2, limits=_HTTP_LIMITS)
+
+##############################################
+# 모델별 LLM 클라이언트 (프로세스당 하나)
+##############################################
+@functools.lru_cache(maxsize=None)
+def get_mistral(model: str = "mistral-large-latest") -> ChatMistralAI:
+    return ChatMistralAI(
+        api_key=MISTRAL_API_KEY,
+        model=model,
+        temperature=0.7,
+        async_client=get_mistral_http(),
+    )
+
+@functools.lru_cache(maxsize=None)
+def get_openai(model: str = "gpt-4o") -> ChatOpenAI:
+    return ChatOpenAI(
+        api_key=OPENAI_API_KEY,
+        model=model,
+        temperature=0.7,
+        http_client=get_openai_http(),
+    )
+
+@functools.lru_cache(maxsize=None)
+def get_mistral_sdk() -> Mistral:
+    # LangChain을 거치지 않는 호출용 Mistral SDK 클라이언트 (같은 연결 풀을 사용)
+    return Mistral(api_key=MISTRAL_API_KEY, async_client=get_mistral_http())
+
+##############################################
+# JSON 응답 파싱 및 복구
+##############################################
+_REPAIR_TEMPLATE = """
+Fix the malformed JSON given at the end so that it is valid JSON matching this JSON schema:
+{schema}
+Keep all of its content. Return only the fixed JSON without any extra text.
+
+Malformed JSON:
+{raw}
+    """
+
+def content_text(content) -> str:
+    """
+    Converts message content (None, a string, or a list of content chunks) to plain text.
+    """
+    if content is None:
+        return ""
+    if isinstance(content, str):
+        return content
+    # 청크 목록: 문자열, {"type": "text", "text": ...} 형태의 dict, 또는 text 속성을 가진 객체
+    parts = []
+    for part in content:
+        if isinstance(part, str):
+            parts.append(part)
+        elif isinstance(part, dict):
+            parts.append(part.get("text") or "")
+        else:
+            parts.append(getattr(part, "text", None) or "")
+    return "".join(parts)
+
+def parse_with_repair(schema, raw):
+    """
+    Parses and validates raw JSON text against the schema, repairing malformed JSON locally before giving up.
+    """
+    raw = content_text(raw)
+    try:
+        return schema.model_validate_json(raw)
+    except ValidationError:
+        return schema.model_validate_json(repair_json(raw))
+
+def llm_repair(schema):
+    """
+    Asks a small model to fix JSON text that could not be repaired locally, then validates it against the schema.
+    """
+    prefix, suffix = _REPAIR_TEMPLATE.replace("{schema}", orjson.dumps(schema.model_json_schema()).decode()).split("{raw}")
+    return (
+        RunnableLambda(lambda raw: prefix + content_text(raw) + suffix)
+        | get_mistral("mistral-small-latest").bind(response_format={"type": "json_object"})
+        | RunnableLambda(lambda message: parse_with_repair(schema, message.content))
+    )
+
+def json_mode(llm, schema):
+    """
+    Calls the LLM in JSON mode and parses and validates the reply against the schema in a single pass.
+    """
+    parse = RunnableLambda(lambda message: parse_with_repair(schema, message.content))
+    # 로컬 복구로도 실패하면 이미 받은 응답을 small 모델로 고쳐 다시 검증합니다.
+    repair = RunnableLambda(lambda message: message.content) | llm_repair(schema)
+    return llm.bind(response_format={"type": "json_object"}) | parse.with_fallbacks(
+        [repair], exceptions_to_handle=(ValidationError,)
+    )
+
+##############################################
+# 응답 캐시
+##############################################
+# 동일한 입력에 대한 LLM 응답을 프로세스가 끝난 뒤에도 재사용하기 위한 디스크 캐시
+RESPONSE_CACHE_PATH = os.environ.get("LLM_RESPONSE_CACHE_PATH", ".llm_cache.db")
+
+# 같은 입력으로 동시에 들어온 비동기 호출이 하나의 LLM 요청을 공유하도록 진행 중인 작업을 기록합니다.
+# 공유 HTTP 클라이언트와 마찬가지로 하나의 이벤트 루프에서만 사용합니다.
+_in_flight = {}
+
+_CACHE_TABLE_READY = False
+
+def _cache_connect() -> sqlite3.Connection:
+    # 테이블은 프로세스에서 처음 연결할 때 한 번만 만듭니다.
+    global _CACHE_TABLE_READY
+    conn = sqlite3.connect(RESPONSE_CACHE_PATH)
+    if not _CACHE_TABLE_READY:
+        try:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+        except sqlite3.Error:
+            conn.close()
+            raise
+        _CACHE_TABLE_READY = True
+    return conn
+
+def _cache_get(key: str):
+    # 캐시를 읽을 수 없으면 (읽기 전용 디렉터리 등) 캐시 미스로 보고 LLM을 호출합니다.
+    try:
+        with contextlib.closing(_cache_connect()) as conn:
+            row = conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+    except sqlite3.Error as e:
+        logger.warning("Response cache read failed (%s): %s", RESPONSE_CACHE_PATH, e)
+        return None
+    return orjson.loads(row[0]) if row else None
+
+def _cache_set(key: str, value) -> None:
+    # 저장에 실패해도 이미 받은 결과는 그대로 반환되도록 경고만 남깁니다.
+    try:
+        with contextlib.closing(_cache_connect()) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO responses (key, value) VALUES (?, ?)", (key, orjson.dumps(value)))
+    except sqlite3.Error as e:
+        logger.warning("Response cache write failed (%s): %s", RESPONSE_CACHE_PATH, e)
+
+def _cache_version(parts) -> str:
+    # 스키마 클래스는 JSON 스키마로, 나머지는 문자열로 바꿔 해시합니다.
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, type) and issubclass(part, BaseModel):
+            part = orjson.dumps(part.model_json_schema(), option=orjson.OPT_SORT_KEYS).decode()
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+def exact_match_cache(*version):
+    """
+    Persistently caches the JSON result of a single-input LLM call in SQLite (RESPONSE_CACHE_PATH), keyed on a hash of the input.
+    The version parts (prompt template, model name, schema class) are hashed into the key, so changing any of them invalidates old entries.
+    Works for both sync and async functions; concurrent async calls with the same input share one LLM request.
+    """
+    version_hash = _cache_version(version)
+
+    def decorator(func):
+        def cache_key(text: str) -> str:
+            return f"{func.__module__}.{func.__name__}@{version_hash}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(text: str):
+                key = cache_key(text)
+                # SQLite 입출력이 이벤트 루프를 막지 않도록 스레드에서 실행합니다.
+                cached = await asyncio.to_thread(_cache_get, key)
+                if cached is not None:
+                    return cached
+                if key not in _in_flight:
+                    _in_flight[key] = asyncio.ensure_future(func(text))
+                try:
+                    result = await asyncio.shield(_in_flight[key])
+                    await asyncio.to_thread(_cache_set, key, result)
+                finally:
+                    _in_flight.pop(key, None)
+                return copy.deepcopy(result)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(text: str):
+            key = cache_key(text)
+            cached = _cache_get(key)
+            if cached is not None:
+                return cached
+            result = func(text)
+            _cache_set(key, result)
+            return result
+        return wrapper
+    return decorator
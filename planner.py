@@ -1,66 +1,92 @@
-import json
+import asyncio
+import contextlib
+import logging
+import os
+import orjson
 import re
-from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
-from langchain_openai import ChatOpenAI
-from langchain_mistralai.chat_models import ChatMistralAI
-
-# ChatMistralAI 초기화 (API 키와 모델 설정)
-llm = ChatMistralAI(
-    api_key="",
-    model="mistral-large-latest",
-    temperature=0.7
-)
+from langchain_core.runnables import RunnableLambda
+from pydantic import BaseModel, Field, ValidationError
+from llm_clients import content_text, exact_match_cache, get_mistral, get_mistral_sdk, json_mode, llm_repair, parse_with_repair
+
+logger = logging.getLogger(__name__)
+
+# ChatMistralAI 초기화 (공유 클라이언트 사용)
+# 플랜 생성과 시스템 프롬프트 작성에는 large 모델을, 텍스트 재작성에 가까운 intent 추출과 정제에는 small 모델을 사용합니다.
+llm_large = get_mistral("mistral-large-latest")
+llm_small = get_mistral("mistral-small-latest")
+
+##############################################
+# LLM 응답 스키마 (JSON 모드 구조화 출력)
+##############################################
+class Intent(BaseModel):
+    caller: str = Field(alias="Caller(You)", description="The role of the caller.")
+    recipient: str = Field(alias="recipient(Opponent)", description="The role of the recipient.")
+    purpose: str = Field(description="The purpose of the call.")
+    context: str = Field(description="Additional context for the call.")
+
+class Action(BaseModel):
+    action: str
+    next: str
+
+class Scenario(BaseModel):
+    name: str
+    description: str
+    chainOfThought: str
+    possibleActions: list[Action]
 
+class CallPlan(BaseModel):
+    scenarios: list[Scenario]
+
+class RefinedPlan(BaseModel):
+    critique: list[str] = []
+    scenarios: list[Scenario]
+
+# 마크다운 코드 펜스(```)와 앞쪽의 'json' 태그를 찾는 패턴
+_FENCE_RE = re.compile(r'^\s*(?:```)?\s*(?:json)?|```', re.IGNORECASE)
 
 def clean_json_output(response_str: str) -> str:
     """
     Removes triple backticks and any markdown formatting from the response.
     """
-    # Remove triple backticks
-    cleaned_response = response_str.replace("```", "")
-    # Optionally, remove any 'json' keyword if it appears immediately after backticks
-    cleaned_response = re.sub(r'^\s*json\s*', '', cleaned_response, flags=re.IGNORECASE)
-    return cleaned_response.strip()
+    # Fast path: already clean JSON needs no regex work
+    if "```" not in response_str and response_str.lstrip()[:4].lower() != "json":
+        return response_str.strip()
+    # Remove every triple backtick and a leading 'json' tag in a single pass
+    return _FENCE_RE.sub("", response_str).strip()
+
+def dumps(obj) -> str:
+    """
+    Serializes an object to compact UTF-8 JSON text for prompt construction.
+    """
+    return orjson.dumps(obj).decode()
 
 ##############################################
 # 사용자 입력에 따른 intent 생성 함수
 ##############################################
-def generate_intent(user_input: str) -> dict:
-    intent_prompt = PromptTemplate(
-        input_variables=["user_input"],
-        template="""
-Based on the following user input, generate a JSON object representing the call intent. The JSON should include the following keys:
+_INTENT_TEMPLATE = """
+Based on the user input below, generate a JSON object representing the call intent. The JSON should include the following keys:
 - "Caller(You)" : The role of the caller.
 - "recipient(Opponent)" : The role of the recipient.
 - "purpose" : The purpose of the call.
 - "context" : Additional context for the call.
 
+Generate the JSON object without any extra explanation.
+
 User input: {user_input}
+    """
+_INTENT_PREFIX, _INTENT_SUFFIX = _INTENT_TEMPLATE.split("{user_input}")
+_INTENT_CHAIN = RunnableLambda(lambda user_input: _INTENT_PREFIX + user_input + _INTENT_SUFFIX) | json_mode(llm_small, Intent)
 
-Generate the JSON object without any extra explanation.
-        """
-    )
-    chain = LLMChain(llm=llm, prompt=intent_prompt, verbose=True)
-    response_str = chain.run(user_input=user_input)
-    response_str = clean_json_output(response_str)
-    try:
-        intent = json.loads(response_str)
-    except json.JSONDecodeError:
-        print("Failed to parse JSON response in generate_intent:", response_str)
-        raise ValueError("Failed to parse JSON response in generate_intent")
-    return intent
+@exact_match_cache(_INTENT_TEMPLATE, llm_small.model, Intent)
+async def generate_intent(user_input: str) -> dict:
+    intent = await _INTENT_CHAIN.ainvoke(user_input)
+    return intent.model_dump(by_alias=True)
 
 ##############################################
 # 1. Chain-of-Thought 기반 초기 통화 플랜 생성 함수
 ##############################################
-def generate_call_plan(intent: dict) -> dict:
-    planning_prompt = PromptTemplate(
-        input_variables=["intent"],
-        template="""
-You are an expert call planning agent. Using a reactive approach and chain-of-thought reasoning, analyze the following call intent and generate a detailed JSON plan that outlines possible situations and corresponding actions, along with your reasoning.
-
-Call intent: {intent}
+_PLANNING_TEMPLATE = """
+You are an expert call planning agent. Using a reactive approach and chain-of-thought reasoning, analyze the call intent given at the end and generate a detailed JSON plan that outlines possible situations and corresponding actions, along with your reasoning.
 
 Requirements:
 1. Under the key "scenarios", list multiple possible scenarios that might occur during the call (especially scenarios triggered by the opponent's messages).
@@ -71,76 +97,113 @@ Requirements:
          a. What subsequent situations or responses the opponent might say/do based on your actions.
          b. What actions (or responses) you can logically take.
    - "possibleActions": A list of possible actions. Each action must be an object with:
-         {{ "action": "Description of what the caller (You) might say/do in response to the opponent's message", "next": "Name of the next scenario or 'END'" }}
+         { "action": "Description of what the caller (You) might say/do in response to the opponent's message", "next": "Name of the next scenario or 'END'" }
 3. The plan should be reactive and capture follow-up steps based on the evolution of the conversation.
 4. Make the next step "END" when your purpose is achieved.
 5. Do not make any judgments (such as making new appointment, or canceling reservation, changing appointment, alternative plan, etc.), If then, next action will be like "I will check and call you back later" and end the conversation.
 6. Output only the JSON without any extra text or explanation.
 
 Please generate the JSON plan.
-        """
-    )
-    chain = LLMChain(llm=llm, prompt=planning_prompt, verbose=True)
-    intent_str = json.dumps(intent, ensure_ascii=False)
-    response_json_str = chain.run(intent=intent_str)
-    response_json_str = clean_json_output(response_json_str)
-    try:
-        plan = json.loads(response_json_str)
-    except json.JSONDecodeError:
-        print("Failed to parse JSON response in generate_call_plan:", response_json_str)
-        raise ValueError("Failed to parse JSON response in generate_call_plan")
-    return plan
+
+Call intent: {intent}
+    """
+_PLANNING_PREFIX, _PLANNING_SUFFIX = _PLANNING_TEMPLATE.split("{intent}")
+_PLANNING_CHAIN = RunnableLambda(lambda intent_str: _PLANNING_PREFIX + intent_str + _PLANNING_SUFFIX) | json_mode(llm_large, CallPlan)
+
+async def generate_call_plan(intent_str: str) -> dict:
+    plan = await _PLANNING_CHAIN.ainvoke(intent_str)
+    return plan.model_dump()
 
 ##############################################
 # 2. Iterative Refinement (반복 정제) 함수
 ##############################################
-def iterative_refinement(plan: dict, intent: dict, iterations: int = 2) -> dict:
-    refined_plan = plan
-    for i in range(iterations):
-        refine_prompt = PromptTemplate(
-            input_variables=["plan_json", "intent"],
-            template="""
-Here is the current call planning information and user intent:
-{plan_json}
-User intent: {intent}
+# 시나리오 정제 시 동시에 보낼 최대 요청 수
+REFINE_MAX_CONCURRENCY = 8
 
-Refine and elaborate this plan to be more detailed and actionable using chain-of-thought reasoning.
-For each scenario, expand the "chainOfThought" to include:
+# 정제 요청의 고정 지시문 (매 요청마다 동일한 system 메시지로 보냅니다)
+_REFINE_INSTRUCTIONS = """
+Critique the call plan given by the user, then refine and elaborate it to be more detailed and actionable using chain-of-thought reasoning.
+Step 1. Critique: under the key "critique", list every concrete problem in the plan (missing follow-up situations, unnecessary situations, vague actions, judgments the caller must not make).
+Step 2. Refine: under the key "scenarios", rewrite the scenarios so that every problem from the critique is resolved. For each scenario, expand the "chainOfThought" to include:
 - Decide to contain situation or remove it logically. (Remove unnecessary situation)
-- Potential follow-up scenarios to add based on each action that undefined in plan.
+- Potential follow-up scenarios to add based on each action whose "next" is neither "END" nor one of the existing scenario names.
 - Do not make any judgments (such as making new appointment, or canceling reservation, changing appointment, alternative plan, etc.), If then, next action will be like "I will check and call you back later" and end the conversation.
-Ensure that the refined plan maintains the same JSON structure.
-Return the refined planning as JSON without any extra text.
-            """
+The user message lists the names of all scenarios already in the plan. They are refined separately, so do not recreate them; "next" may point to any of them.
+Keep the name of the scenario you refine, and give every added scenario a new, unique name.
+Ensure that each refined scenario keeps the same JSON structure as in the plan.
+Return {"critique": [...], "scenarios": [...]} as JSON without any extra text.
+"""
+
+_REFINE_REPAIR = llm_repair(RefinedPlan)
+
+async def _refine_scenario(scenario: dict, names_str: str, intent_str: str, semaphore: asyncio.Semaphore) -> RefinedPlan:
+    # 호출 수가 많은 단계이므로 LangChain을 거치지 않고 Mistral SDK를 직접 호출합니다.
+    async with semaphore:
+        response = await get_mistral_sdk().chat.complete_async(
+            model=llm_small.model,
+            temperature=llm_small.temperature,
+            messages=[
+                {"role": "system", "content": _REFINE_INSTRUCTIONS},
+                {
+                    "role": "user",
+                    "content": (
+                        f"User intent: {intent_str}\n\n"
+                        f"Existing scenario names: {names_str}\n\n"
+                        f"Here is the scenario to refine:\n{dumps({'scenarios': [scenario]})}"
+                    ),
+                },
+            ],
+            response_format={"type": "json_object"},
         )
-        chain = LLMChain(llm=llm, prompt=refine_prompt, verbose=True)
-        plan_json_str = json.dumps(refined_plan, ensure_ascii=False, indent=2)
-        intent_str = json.dumps(intent, ensure_ascii=False)
-        response_json_str = chain.run(plan_json=plan_json_str, intent=intent_str)
-        response_json_str = clean_json_output(response_json_str)
-        try:
-            refined_plan = json.loads(response_json_str)
-        except json.JSONDecodeError:
-            print("Failed to parse JSON response in iterative_refinement, iteration", i+1, ":", response_json_str)
-            raise ValueError("Failed to parse JSON response in iterative_refinement, iteration " + str(i+1))
+    content = response.choices[0].message.content
+    try:
+        return parse_with_repair(RefinedPlan, content)
+    except ValidationError:
+        return await _REFINE_REPAIR.ainvoke(content)
+
+def _merge_scenarios(originals: list, responses: list) -> list:
+    """
+    Merges per-scenario refinements into one scenario list, keeping a single scenario per name.
+    A scenario whose refinement raised is kept as it was.
+    """
+    merged = {}
+    # 각 요청이 정제한 원래 시나리오를 먼저 넣어, 다른 요청이 같은 이름으로 다시 만든 시나리오보다 우선하게 합니다.
+    for original, response in zip(originals, responses):
+        if isinstance(response, BaseException):
+            # 정제에 실패한 시나리오는 원래 내용을 그대로 유지합니다.
+            logger.warning("Refinement failed for scenario %r, keeping the original: %r", original["name"], response)
+            merged[original["name"]] = original
+            continue
+        for scenario in response.scenarios:
+            if scenario.name == original["name"]:
+                merged[scenario.name] = scenario.model_dump()
+    # 새로 추가된 시나리오는 이름이 겹치지 않을 때만 넣습니다.
+    for response in responses:
+        if isinstance(response, BaseException):
+            continue
+        for scenario in response.scenarios:
+            merged.setdefault(scenario.name, scenario.model_dump())
+    return list(merged.values())
+
+async def iterative_refinement(plan: dict, intent_str: str, iterations: int = 1) -> dict:
+    semaphore = asyncio.Semaphore(REFINE_MAX_CONCURRENCY)
+    refined_plan = plan
+    for _ in range(iterations):
+        # 시나리오별 요청을 동시에 보내 정제한 뒤 다시 하나의 플랜으로 합칩니다.
+        originals = refined_plan.get("scenarios", [])
+        names_str = dumps([scenario["name"] for scenario in originals])
+        responses = await asyncio.gather(*[
+            _refine_scenario(scenario, names_str, intent_str, semaphore)
+            for scenario in originals
+        ], return_exceptions=True)
+        refined_plan = {**refined_plan, "scenarios": _merge_scenarios(originals, responses)}
     return refined_plan
 
 ##############################################
 # 3. 최종 시스템 프롬프트 생성 함수
 ##############################################
-def create_cot_system_prompt_from_plan(plan: dict, intent: dict) -> str:
-    """
-    - intent에 따라 caller(전화 거는 AI)의 역할을 명확히 하고,
-      상대방(전화 받는 측)의 반응에 따른 내 행동을 구체적으로 안내합니다.
-    - AI가 판단할 수 없는(결정이 필요한) 상황에서는 즉시 전화를 종료하도록 합니다.
-    """
-    system_prompt = PromptTemplate(
-        input_variables=["plan_json", "intent"],
-        template="""
-You are an AI tasked with creating a system prompt for another conversation AI agent. The call plan below contains the user's intent and detailed scenarios for handling the call:
-{plan_json}
-
-User intent: {intent}
+_SYSTEM_TEMPLATE = """
+You are an AI tasked with creating a system prompt for another conversation AI agent. The call plan given at the end contains the user's intent and detailed scenarios for handling the call.
 
 Follow the instructions below:
 1. Create a system prompt that clearly explains the situation, the role of the conversation AI agent (the caller), the opponent (e.g., restaurant staff), and the purpose of the conversation.
@@ -152,51 +215,88 @@ Follow the instructions below:
 Make final system prompt. Use the plan and these instructions to guide the conversation effectively.
 
 Output format should be json format:
-```json {{
+```json {
     "system_prompt": "System prompt",
     "first_message": "First message"
-    }}
+    }
 ```
 
+User intent: {intent}
 
-        """
-    )
-    chain = LLMChain(llm=llm, prompt=system_prompt, verbose=True)
-    plan_json_str = json.dumps(plan, ensure_ascii=False, indent=2)
-    intent_str = json.dumps(intent, ensure_ascii=False)
-    final_output = chain.run(plan_json=plan_json_str, intent=intent_str)
+Call plan:
+{plan_json}
+    """
+_SYSTEM_PREFIX, _SYSTEM_MIDDLE, _SYSTEM_SUFFIX = re.split(r"\{intent\}|\{plan_json\}", _SYSTEM_TEMPLATE)
+_SYSTEM_PROMPT = RunnableLambda(
+    lambda inputs: _SYSTEM_PREFIX + inputs["intent"] + _SYSTEM_MIDDLE + inputs["plan_json"] + _SYSTEM_SUFFIX
+)
+_SYSTEM_PROMPT_CHAIN = _SYSTEM_PROMPT | llm_large
+# 스트리밍 응답이 JSON으로 시작하지 않을 때 한 번 더 요청하는 JSON 모드 체인
+_SYSTEM_PROMPT_JSON_CHAIN = _SYSTEM_PROMPT | llm_large.bind(response_format={"type": "json_object"})
 
-    final_output = clean_json_output(final_output)
+async def create_cot_system_prompt_from_plan(plan: dict, intent_str: str) -> str:
+    """
+    - intent에 따라 caller(전화 거는 AI)의 역할을 명확히 하고,
+      상대방(전화 받는 측)의 반응에 따른 내 행동을 구체적으로 안내합니다.
+    - AI가 판단할 수 없는(결정이 필요한) 상황에서는 즉시 전화를 종료하도록 합니다.
+    """
+    inputs = {"intent": intent_str, "plan_json": dumps(plan)}
+    # 응답을 스트리밍으로 받으면서 JSON 객체로 시작하는지 미리 확인합니다.
+    chunks = []
+    checked = False
+    async with contextlib.aclosing(_SYSTEM_PROMPT_CHAIN.astream(inputs)) as stream:
+        async for chunk in stream:
+            chunks.append(content_text(chunk.content))
+            if not checked:
+                head = "".join(chunks).strip()
+                cleaned = clean_json_output(head)
+                if cleaned.startswith("{"):
+                    checked = True
+                elif cleaned and len(head) >= len("```json{"):
+                    # JSON이 아닌 응답은 스트림을 닫아 생성을 중단합니다.
+                    break
+
+    if not checked:
+        # 앞선 단계의 결과를 버리지 않도록 JSON 모드로 한 번 더 요청합니다.
+        logger.warning("Non-JSON response in create_cot_system_prompt_from_plan, retrying in JSON mode: %s", "".join(chunks))
+        message = await _SYSTEM_PROMPT_JSON_CHAIN.ainvoke(inputs)
+        return clean_json_output(content_text(message.content))
+
+    final_output = clean_json_output("".join(chunks))
     return final_output
 
 ##############################################
 # 4. 통합 실행 예제
 ##############################################
-def main():
+async def main_async():
     # 사용자 입력 예시
     user_input = (
         "Want to ask insurance company about my car insurance. when my insurance is expired, and I want to renew."
     )
     
     # 0) 사용자 입력에 따라 intent 생성
-    intent = generate_intent(user_input)
-    print("\n[Generated Intent]")
-    print(json.dumps(intent, ensure_ascii=False, indent=2))
+    intent = await generate_intent(user_input)
+    # 이후 단계에서 재사용하도록 intent를 한 번만 직렬화합니다.
+    intent_str = dumps(intent)
+    logger.debug("Generated intent: %s", intent)
     
     # 1) 초기 플랜 생성 (CoT 방식)
-    initial_plan = generate_call_plan(intent)
-    print("\n[Initial Call Plan]")
-    print(json.dumps(initial_plan, ensure_ascii=False, indent=2))
+    initial_plan = await generate_call_plan(intent_str)
+    logger.debug("Initial call plan: %s", initial_plan)
     
-    # 2) 반복 정제: 플랜을 3회 반복하여 상세화
-    refined_plan = iterative_refinement(initial_plan, intent, iterations=3)
-    print("\n[Refined Call Plan]")
-    print(json.dumps(refined_plan, ensure_ascii=False, indent=2))
+    # 2) 정제: 자기 비평 후 한 번에 플랜을 상세화
+    refined_plan = await iterative_refinement(initial_plan, intent_str)
+    logger.debug("Refined call plan: %s", refined_plan)
     
     # 3) 최종 시스템 프롬프트 생성 (AI가 판단할 수 없는 경우 즉시 종료)
-    final_system_prompt = create_cot_system_prompt_from_plan(refined_plan, intent)
-    print("\n[Final System Prompt]")
+    final_system_prompt = await create_cot_system_prompt_from_plan(refined_plan, intent_str)
     print(final_system_prompt)
 
+def main():
+    # 중간 결과는 LOG_LEVEL=DEBUG 일 때만 출력합니다.
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    asyncio.run(main_async())
+
 if __name__ == "__main__":
     main()
@@ -1,32 +1,26 @@
-import json
-import re
-from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
-from langchain_openai import ChatOpenAI
-
-# ChatMistralAI 초기화 (API 키와 모델 설정)
-llm = ChatOpenAI(
-    api_key="",
-    model="gpt-4o",
-    temperature=0.7
-)
-
-def clean_json_output(response_str: str) -> str:
-    """
-    Removes triple backticks and any markdown formatting from the response.
-    """
-    cleaned_response = response_str.replace("```", "")
-    cleaned_response = re.sub(r'^\s*json\s*', '', cleaned_response, flags=re.IGNORECASE)
-    return cleaned_response.strip()
+import orjson
+from langchain_core.runnables import RunnableLambda
+from pydantic import BaseModel
+from typing import Optional, Union
+from llm_clients import exact_match_cache, get_openai, json_mode
+
+# ChatOpenAI 초기화 (공유 클라이언트 사용)
+llm = get_openai()
+
+# 통화 요약 응답 스키마 (JSON 모드 구조화 출력)
+class Summary(BaseModel):
+    recipient: str
+    purpose: str
+    result: str
+    failureReason: Optional[str] = None
+    nextSteps: Union[str, list[str]]
+    additionalDetails: Union[str, list[str], None] = None
 
 ##############################################
 # 통화 기록을 요약하는 함수
 ##############################################
-def summarize_call_log(call_log: str) -> dict:
-    summary_prompt = PromptTemplate(
-        input_variables=["call_log"],
-        template="""
-Based on the following call record, generate a JSON summary with the following keys:
+_SUMMARY_TEMPLATE = """
+Based on the call record given at the end, generate a JSON summary with the following keys:
 1. "recipient": the party that received the call.
 2. "purpose": the purpose of the call.
 3. "result": indicate "success" if the purpose was achieved, or "failure" otherwise.
@@ -34,20 +28,17 @@ Based on the following call record, generate a JSON summary with the following k
 5. "nextSteps": what the user should do next (for example, call back or make a decision).
 6. "additionalDetails": any additional information the user should be aware of.
 
+Output only the JSON summary without any extra text or explanation.
+
 Call record: {call_log}
+    """
+_SUMMARY_PREFIX, _SUMMARY_SUFFIX = _SUMMARY_TEMPLATE.split("{call_log}")
+_SUMMARY_CHAIN = RunnableLambda(lambda call_log: _SUMMARY_PREFIX + call_log + _SUMMARY_SUFFIX) | json_mode(llm, Summary)
 
-Output only the JSON summary without any extra text or explanation.
-        """
-    )
-    chain = LLMChain(llm=llm, prompt=summary_prompt, verbose=True)
-    response_str = chain.run(call_log=call_log)
-    response_str = clean_json_output(response_str)
-    try:
-        summary = json.loads(response_str)
-    except json.JSONDecodeError:
-        print("Failed to parse JSON response in summarize_call_log:", response_str)
-        raise ValueError("Failed to parse JSON response in summarize_call_log")
-    return summary
+@exact_match_cache(_SUMMARY_TEMPLATE, llm.model_name, Summary)
+def summarize_call_log(call_log: str) -> dict:
+    summary = _SUMMARY_CHAIN.invoke(call_log)
+    return summary.model_dump()
 
 ##############################################
 # 통합 실행 예제
@@ -93,8 +84,7 @@ Tool called: end_call
     
     # 통화 기록 요약 생성
     summary = summarize_call_log(call_record)
-    print("\n[Call Record Summary]")
-    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    print(orjson.dumps(summary, option=orjson.OPT_INDENT_2).decode())
 
 if __name__ == "__main__":
     main()